@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+#
+#           Clocks.
+#
+# Everything that depends on the time of day or waits for a while (the
+# idle_timeout, the timestamp annotation timer, the file names) asks a clock
+# rather than calling datetime.now() or starting a threading.Timer itself.
+# Normally that's the WallClock, which does just that.  replay.py uses the
+# VirtualClock instead, so it can run through a whole night in seconds.
+
+import datetime
+import heapq
+from threading import Timer
+
+class WallClock:
+    """The real time"""
+
+    def now(self):
+        return datetime.datetime.now()
+
+    def timer(self, interval, function):
+        """Return a timer (not yet started) that calls function after interval seconds"""
+        return Timer(interval, function)
+
+class VirtualTimer:
+    """A timer on a VirtualClock, with the start() and cancel() of threading.Timer"""
+
+    def __init__(self, clock, interval, function):
+        self.clock = clock
+        self.interval = interval
+        self.function = function
+        self.cancelled = False
+
+    def start(self):
+        self.clock.schedule(self.clock.now() + datetime.timedelta(seconds=self.interval), self)
+
+    def cancel(self):
+        self.cancelled = True
+
+class VirtualClock:
+    """A clock that only moves when advance() is called
+
+    Timers fire, in order, on the thread that calls advance(), when the time
+    passes their due time.
+    """
+
+    def __init__(self, start):
+        self.time = start
+        self.pending = []  # Heap of (due time, sequence number, timer)
+        self.sequence = 0
+
+    def now(self):
+        return self.time
+
+    def timer(self, interval, function):
+        return VirtualTimer(self, interval, function)
+
+    def schedule(self, due, timer):
+        heapq.heappush(self.pending, (due, self.sequence, timer))
+        self.sequence += 1
+
+    def advance(self, seconds):
+        """Move the time forward, firing any timers that come due on the way"""
+        end = self.time + datetime.timedelta(seconds=seconds)
+        while self.pending and self.pending[0][0] <= end:
+            (due, _, timer) = heapq.heappop(self.pending)
+            if timer.cancelled:
+                continue
+            self.time = max(self.time, due)
+            timer.function()
+        self.time = end
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+#
+#           Motion activity heatmap.
+#
+# Keeps a coarse grid (heatmap_cells in conf.json, 48 x 27 by default) over
+# the frame, and for every frame the detector looks at, adds to each cell:
+#
+#   activity - the fraction of the cell that was over the motion threshold
+#   level    - the average difference (frame_diff) or vector length
+#              (motion_vectors) in the cell, whether it was over or not
+#
+# Both decay away with a half life of heatmap_half_life seconds of wall clock
+# time (however many frames a second the loop actually manages), so the map
+# follows changes like the seasons (or a new bush growing into the view).
+# Everything is done in place on small float arrays, so it costs next to
+# nothing per frame.  They are float64, as adding a frame's worth to a sum
+# of tens of thousands in float32 loses too much to rounding.
+#
+# The map is saved to heatmap_file every SAVE_INTERVAL_SEC, and when the
+# program quits, and is picked up again at the next start.  Leave
+# heatmap_file out of conf.json to turn the heatmap off.
+#
+# heatmap_report.py reads the saved map and suggests exclusion zones and
+# thresholds.
+
+import os
+import time
+
+import cv2
+import numpy as np
+
+SAVE_INTERVAL_SEC = 300
+
+class ActivityHeatmap:
+
+    def __init__(self, conf):
+        self.path = conf["heatmap_file"]
+        self.cells = tuple(conf.get("heatmap_cells", [48, 27]))  # (columns, rows)
+        self.half_life = conf.get("heatmap_half_life", 3600)
+        shape = (self.cells[1], self.cells[0])
+        self.activity = np.zeros(shape, np.float64)
+        self.level = np.zeros(shape, np.float64)
+        self.frames = 0.0  # Decayed count of frames added, to turn the sums into averages.
+        self.last_add = time.time()
+        self.last_save = self.last_add
+        if os.path.exists(self.path):
+            self.load()
+
+    def load(self):
+        data = np.load(self.path)
+        if data["activity"].shape == self.activity.shape:
+            self.activity[:] = data["activity"]
+            self.level[:] = data["level"]
+            self.frames = float(data["frames"])
+            # Let it fade for the time the program wasn't running, too.
+            if "time" in data:
+                self.last_add = min(float(data["time"]), self.last_add)
+        else:
+            print("[INFO] heatmap_cells changed, starting a new heatmap")
+
+    def save(self):
+        # Write to a temporary file first, so a crash part way leaves the old map intact.
+        # (np.savez adds .npz to names that don't already end with it.)
+        tmp = self.path + ".tmp.npz"
+        np.savez(tmp, activity=self.activity, level=self.level, frames=self.frames, time=self.last_add)
+        os.replace(tmp, self.path)
+        self.last_save = time.time()
+
+    def add(self, mask, level):
+        """Add one frame to the heatmap
+
+        mask is the detector's thresholded (0 or 255) motion image, and level the
+        image it was thresholded from.  Either can be any size; they are scaled
+        down to the heatmap grid.
+        """
+        now = time.time()
+        decay = 0.5 ** (max(now - self.last_add, 0) / self.half_life)
+        self.last_add = now
+        self.activity *= decay
+        self.activity += cv2.resize(mask, self.cells, interpolation=cv2.INTER_AREA) / 255.0
+        self.level *= decay
+        self.level += cv2.resize(level, self.cells, interpolation=cv2.INTER_AREA)
+        self.frames = self.frames * decay + 1
+        if now - self.last_save > SAVE_INTERVAL_SEC:
+            self.save()
+
+def create_heatmap(conf):
+    """Return an ActivityHeatmap if heatmap_file is set in conf.json, otherwise None"""
+    if conf.get("heatmap_file"):
+        return ActivityHeatmap(conf)
+    return None
@@ -0,0 +1,99 @@
+#!/usr/bin/python3
+# Report on the motion activity heatmap saved by video_surveillance.py.
+#
+# Tuning min_area, delta_thresh and the exclusion zones by trial and error is
+# slow.  This reads the heatmap (see heatmap.py) and:
+#
+#   - Prints a map of how often each part of the picture has had motion.
+#   - Lists the chronically noisy regions: cells with motion in more than
+#     --noisy (5% by default) of the frames.
+#   - Suggests exclusion_zones for the bigger noisy regions, and a min_area
+#     just over the size of the smaller, scattered ones.
+#   - Suggests a delta_thresh (or mv_magnitude, for the motion_vectors
+#     detector) of noise_factor times the noise level of the quiet parts of
+#     the picture, the same margin AdaptiveThreshold in motion_detector.py
+#     uses.  With adaptive_thresh on, delta_thresh is only the floor under
+#     the measured threshold, and only matters when the picture is quiet.
+#
+# Nothing is changed; copy whatever you agree with into conf.json.
+#
+# Usage:
+#   python3 heatmap_report.py --conf conf.json
+from motion_detector import FRAME_WIDTH
+import argparse
+import cv2
+import json
+import math
+import numpy as np
+
+SHADES = " .:-=+*#%@"  # Map characters, from no motion to the busiest cell.
+
+def main():
+    # Construct the argument parser and parse the arguments.
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-c", "--conf", required=True, help="Path to the JSON configuration file")
+    ap.add_argument("--heatmap", help="Heatmap file (default: heatmap_file from the configuration file)")
+    ap.add_argument("--noisy", type=float, default=0.05, help="Fraction of frames with motion for a cell to count as noisy")
+    ap.add_argument("--zone-cells", type=int, default=4, help="Smallest noisy region, in cells, to suggest an exclusion zone for")
+    args = vars(ap.parse_args())
+
+    conf = json.load(open(args["conf"]))
+    data = np.load(args["heatmap"] or conf["heatmap_file"])
+    frames = float(data["frames"])
+    if frames < 1:
+        print("The heatmap is empty")
+        return
+    activity = data["activity"] / frames
+    level = data["level"] / frames
+
+    # Size of a cell, in FRAME_WIDTH wide frame coordinates.
+    rows, cols = activity.shape
+    frame_height = FRAME_WIDTH * conf["resolution"][1] / conf["resolution"][0]
+    cell_w = FRAME_WIDTH / cols
+    cell_h = frame_height / rows
+
+    busiest = max(float(activity.max()), 1e-6)
+    print("Motion activity (about {:.0f} frames' worth, {} = motion in {:.0%} of frames):".format(
+        frames, SHADES[-1], busiest))
+    print("+" + "-" * cols + "+")
+    for row in activity:
+        shades = np.minimum((row / busiest * len(SHADES)).astype(int), len(SHADES) - 1)
+        print("|" + "".join(SHADES[s] for s in shades) + "|")
+    print("+" + "-" * cols + "+")
+
+    noisy = activity >= args["noisy"]
+    count, _, stats, _ = cv2.connectedComponentsWithStats(noisy.astype(np.uint8), connectivity=8)
+    zones = []
+    small_area = 0
+    print("\nNoisy regions (motion in at least {:.0%} of frames):".format(args["noisy"]))
+    for (col, row, w, h, cells) in stats[1:count]:
+        zone = [int(col * cell_w), int(row * cell_h), int((col + w) * cell_w), int((row + h) * cell_h)]
+        print("  x {}..{}, y {}..{}: {} cells, {:.0%} of frames at the worst".format(
+            zone[0], zone[2], zone[1], zone[3], cells, activity[row:row + h, col:col + w].max()))
+        if cells >= args["zone_cells"]:
+            zones.append(zone)
+        else:
+            small_area = max(small_area, cells * cell_w * cell_h)
+    if count <= 1:
+        print("  None")
+
+    print("\nSuggestions:")
+    if zones:
+        print('  "exclusion_zones": {},'.format(json.dumps(conf.get("exclusion_zones", []) + zones)))
+    if small_area >= conf["min_area"]:
+        print('  "min_area": {},  (now {})'.format(int(math.ceil(small_area)) + 1, conf["min_area"]))
+
+    # The typical level of the parts of the picture that hardly ever have motion
+    # is the sensor noise (or encoder jitter), so the threshold wants to be well over it.
+    quiet = level[~noisy]
+    if quiet.size:
+        key = "mv_magnitude" if conf.get("detector") == "motion_vectors" else "delta_thresh"
+        suggested = int(math.ceil(conf.get("noise_factor", 8) * float(np.median(quiet))))
+        if suggested > conf[key]:
+            floor = ""
+            if key == "delta_thresh" and conf.get("adaptive_thresh"):
+                floor = "  (only the floor: adaptive_thresh raises it with the noise anyway)"
+            print('  "{}": {},  (now {}){}'.format(key, suggested, conf[key], floor))
+
+if __name__ == "__main__":
+    main()
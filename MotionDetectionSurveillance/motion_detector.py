@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+#
+#           Motion detector backends.
+#
+# This module is used by video_surveillance.py, which owns the camera and the
+# IDLE/ACTIVE/RECORDING state machine.  A detector is handed each (resized,
+# 960 pixel wide) frame and returns the bounding boxes, as (x, y, w, h) in that
+# frame's coordinates, of the areas of motion that are big enough to count and
+# are not inside the timestamp exclusion zone.
+#
+# Two backends are available, selected by "detector" in conf.json:
+#
+#   frame_diff     - The original pyimagesearch approach.  Blur the frame, keep
+#                    a running average of it, and threshold the difference.
+#                    Simple, but the blur and differencing at 960 pixels wide
+#                    are most of the CPU time of the whole program.
+#   motion_vectors - Uses the motion vectors the GPU's H.264 encoder computes
+#                    anyway (see motion_vectors.py).  Much cheaper.
+#
+# Both apply the same min_area and x_min..y_max exclusion zone settings, plus
+# any extra exclusion_zones (see is_excluded), and both feed the activity
+# heatmap if heatmap_file is set (see heatmap.py).
+#
+# With adaptive_thresh set, frame_diff also adapts to the lighting (see
+# AdaptiveThreshold): the NoIR camera is much noisier at night, and a fixed
+# delta_thresh that works in the day makes for hours of recordings of nothing.
+
+from heatmap import create_heatmap
+import cv2
+import math
+
+FRAME_WIDTH = 960  # Width frames are resized to before detection/display.
+
+def is_excluded(x, y, conf):
+    """Return True if a box with top left corner x, y is in an exclusion zone
+
+    We don't want the updating of the timestamp to be detected as motion and keep
+    the recording alive forever.  That zone is given by x_min, x_max, y_min, y_max
+    in conf.json, in FRAME_WIDTH wide frame coordinates.  Other known noisy areas
+    (a tree waving in the wind, say) can be listed in exclusion_zones, as
+    [x_min, y_min, x_max, y_max] in the same coordinates.  heatmap_report.py
+    suggests some.
+    """
+    # Temporary info to help determine / tune the values.
+    # May still need some tweaking for the lower limit of x, for hour,
+    # day, year changes.  Probably not worth the effort though.
+    #print("x:", x, "y:", y)
+    if conf["x_min"] <= x <= conf["x_max"] and conf["y_min"] <= y <= conf["y_max"]:
+        return True
+    for (zx_min, zy_min, zx_max, zy_max) in conf.get("exclusion_zones", []):
+        if zx_min <= x <= zx_max and zy_min <= y <= zy_max:
+            return True
+    return False
+
+class AdaptiveThreshold:
+    """Keep track of the lighting and noise level, and pick the threshold and learning rate to suit
+
+    Both are measured on every NOISE_STRIDE'th pixel of every NOISE_STRIDE'th row
+    only, and smoothed over a few seconds, so it costs very little:
+
+      - The brightness of the (blurred) frame decides the lighting regime.  Below
+        night_brightness it's night, above night_brightness + REGIME_HYSTERESIS
+        it's day again.  Each regime has its own background learning rate
+        (day_alpha, night_alpha); a lower rate averages over more frames, which
+        smooths out more of the noise.
+      - The noise level is the average difference between the frame and the
+        background, leaving out the pixels over the threshold (which are motion).
+        The threshold is noise_factor times that, but never less than
+        delta_thresh.  The average difference is about 0.8 of the standard
+        deviation of the noise, so the default of 8 is about 6 standard
+        deviations; much less and the blotchy night time noise still gets
+        through the blur.
+    """
+
+    NOISE_STRIDE = 8        # Sample every 8th pixel of every 8th row.
+    NOISE_SMOOTHING = 0.02  # Weight of each new frame in the smoothed levels.
+    REGIME_HYSTERESIS = 10  # Brightness margin, so dusk doesn't flip back and forth.
+
+    def __init__(self, conf):
+        self.conf = conf
+        self.brightness = None
+        self.noise = 0.0
+        self.night = False
+        self.thresh = conf["delta_thresh"]
+
+    @property
+    def regime(self):
+        return "night" if self.night else "day"
+
+    @property
+    def alpha(self):
+        return self.conf.get("night_alpha", 0.1) if self.night else self.conf.get("day_alpha", 0.5)
+
+    def update(self, gray, frameDelta):
+        """Update the levels from a frame's blurred grayscale image and its difference from the background"""
+        s = self.NOISE_STRIDE
+        brightness = float(gray[::s, ::s].mean())
+        # Leave out whatever is over the threshold already; that's motion, not noise.
+        sample = frameDelta[::s, ::s]
+        quiet = sample[sample < self.thresh]
+        noise = float(quiet.mean()) if quiet.size else self.noise
+        if self.brightness is None:
+            self.brightness = brightness
+            self.noise = noise
+        else:
+            self.brightness += self.NOISE_SMOOTHING * (brightness - self.brightness)
+            self.noise += self.NOISE_SMOOTHING * (noise - self.noise)
+
+        night_brightness = self.conf.get("night_brightness", 40)
+        if self.night and self.brightness > night_brightness + self.REGIME_HYSTERESIS:
+            self.night = False
+            print("[INFO] lighting regime: day")
+        elif not self.night and self.brightness < night_brightness:
+            self.night = True
+            print("[INFO] lighting regime: night")
+
+        noise_thresh = int(math.ceil(self.conf.get("noise_factor", 8) * self.noise))
+        self.thresh = max(self.conf["delta_thresh"], noise_thresh)
+
+class FrameDiffDetector:
+    """Detect motion by differencing each frame against a running average of past frames"""
+
+    def __init__(self, conf):
+        self.conf = conf
+        self.avg = None
+        self.heatmap = create_heatmap(conf)
+        self.adaptive = AdaptiveThreshold(conf) if conf.get("adaptive_thresh") else None
+
+    def start(self):
+        """Nothing to start; frames are handed to detect() by the frame loop"""
+        pass
+
+    def stop(self):
+        """Save the heatmap, if there is one"""
+        if self.heatmap is not None:
+            self.heatmap.save()
+
+    def detect(self, frame):
+        """Return the list of motion boxes in the frame
+
+        Returns None for the first frame, which only initializes the background model.
+        """
+        # Convert the frame to grayscale, and blur it.
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        gray = cv2.GaussianBlur(gray, (21, 21), 0)
+
+        # If the average frame is None, initialize it
+        if self.avg is None:
+            print("[INFO] starting background model...")
+            self.avg = gray.copy().astype("float")
+            return None
+
+        # Accumulate the weighted average between the current frame and
+        # previous frames, then compute the difference between the current
+        # frame and running average.
+        alpha = self.adaptive.alpha if self.adaptive else 0.5
+        cv2.accumulateWeighted(gray, self.avg, alpha)
+        frameDelta = cv2.absdiff(gray, cv2.convertScaleAbs(self.avg))
+
+        # Threshold the delta image, dilate the thresholded image to fill
+        # in holes, then find contours on thresholded image
+        delta_thresh = self.conf["delta_thresh"]
+        if self.adaptive:
+            self.adaptive.update(gray, frameDelta)
+            delta_thresh = self.adaptive.thresh
+        thresh = cv2.threshold(frameDelta, delta_thresh, 255, cv2.THRESH_BINARY)[1]
+        thresh = cv2.dilate(thresh, None, iterations=2)
+        if self.heatmap is not None:
+            self.heatmap.add(thresh, frameDelta)
+        cnts = cv2.findContours(thresh.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        # OpenCV 2 and 4 return (contours, hierarchy), OpenCV 3 (image, contours, hierarchy).
+        cnts = cnts[0] if len(cnts) == 2 else cnts[1]
+
+        boxes = []
+        for c in cnts:
+            # If the contour is too small, ignore it.
+            # This is a value you may want to tweak to your own preference.
+            if cv2.contourArea(c) < self.conf["min_area"]:
+                continue
+
+            # Compute the bounding box for the contour
+            (x, y, w, h) = cv2.boundingRect(c)
+            if not is_excluded(x, y, self.conf):
+                boxes.append((x, y, w, h))
+        return boxes
+
+def create_detector(conf, camera=None):
+    """Create the detector backend selected by "detector" in conf.json
+
+    The motion_vectors backend needs the camera, to attach itself to the encoder.
+    """
+    name = conf.get("detector", "frame_diff")
+    if name == "frame_diff":
+        return FrameDiffDetector(conf)
+    elif name == "motion_vectors":
+        from motion_vectors import MotionVectorDetector
+        return MotionVectorDetector(conf, camera)
+    else:
+        raise ValueError("Unexpected value for detector: ", name)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+#
+#           Motion vector detector backend.
+#
+# The GPU's H.264 encoder works out a motion vector for every 16x16 pixel
+# macroblock of every frame, and picamera will hand those to us for free via
+# the motion_output of start_recording().  So rather than blurring and
+# differencing whole frames on the CPU, this backend records a small, throwaway
+# stream (to /dev/null) on a spare splitter port, and just looks at the vectors:
+#
+#   - Any macroblock whose vector is at least mv_magnitude (in conf.json) long
+#     is considered moving.
+#   - Adjoining moving macroblocks are grouped into blobs.
+#   - Macroblocks that overlap the x_min..y_max timestamp exclusion zone or any
+#     of the exclusion_zones are ignored.  (Blobs are only accurate to a
+#     macroblock, so checking just their top left corner, as frame_diff does,
+#     would miss the timestamp, which the camera draws on this stream too.)
+#   - Each blob's bounding box is scaled up to 960 pixel wide frame coordinates
+#     so that min_area means the same thing as it does for the frame_diff backend.
+#
+# The pure NumPy part (find_motion_blobs) doesn't need a camera, so it can be
+# tried out with made up vector arrays.
+
+import threading
+
+import cv2
+import numpy as np
+try:
+    from picamera.array import PiMotionAnalysis
+except ImportError:
+    # Allow find_motion_blobs to be used without a camera.
+    PiMotionAnalysis = object
+
+from heatmap import create_heatmap
+from motion_detector import FRAME_WIDTH
+
+MACROBLOCK_SIZE = 16     # Pixels on a side of an H.264 macroblock.
+MOTION_SPLITTER_PORT = 2 # VideoRecorder uses the default port (1) for the real recordings.
+
+def motion_magnitude(vectors):
+    """Return the length of each motion vector in a picamera motion data array
+
+    The array has int8 fields x and y (and a uint16 sad field, which isn't used).
+    """
+    x = vectors['x'].astype(np.float32)
+    y = vectors['y'].astype(np.float32)
+    return np.sqrt(np.square(x) + np.square(y))
+
+def find_motion_blobs(vectors, min_magnitude, min_blocks=1):
+    """Group moving macroblocks into blobs
+
+    Returns a list of (col, row, cols, rows, blocks) tuples, in macroblock units,
+    one per blob of at least min_blocks adjoining macroblocks whose motion vectors
+    are at least min_magnitude long.
+    """
+    return find_mask_blobs(motion_magnitude(vectors) >= min_magnitude, min_blocks)
+
+def find_mask_blobs(moving, min_blocks=1):
+    """Group the True macroblocks of a boolean mask into blobs, as for find_motion_blobs"""
+    if not moving.any():
+        return []
+    count, _, stats, _ = cv2.connectedComponentsWithStats(moving.astype(np.uint8), connectivity=8)
+    # Label 0 is the background (the non moving blocks).
+    stats = stats[1:count]
+    stats = stats[stats[:, cv2.CC_STAT_AREA] >= min_blocks]
+    return [tuple(int(v) for v in s) for s in stats]
+
+class MotionVectorDetector(PiMotionAnalysis):
+    """Detect motion from the H.264 encoder's motion vectors
+
+    analyze() is called by picamera, on its own thread, once per encoded frame.
+    detect() is called from the frame loop and returns the boxes of the latest
+    frame the encoder has given us.
+    """
+
+    def __init__(self, conf, camera):
+        self.conf = conf
+        self.size = tuple(conf.get("mv_resolution", [640, 360]))
+        # Scale from macroblocks to pixels of the FRAME_WIDTH wide frame, which
+        # has the aspect ratio of the camera's resolution.
+        frame_height = FRAME_WIDTH * conf["resolution"][1] / conf["resolution"][0]
+        self.scale_x = MACROBLOCK_SIZE * FRAME_WIDTH / self.size[0]
+        self.scale_y = MACROBLOCK_SIZE * frame_height / self.size[1]
+        self.excluded = self.exclusion_mask()
+        self.lock = threading.Lock()
+        self.boxes = None
+        self.heatmap = create_heatmap(conf)
+        if camera is not None:
+            super().__init__(camera, size=self.size)
+        self.camera = camera
+
+    def exclusion_mask(self):
+        """Return a boolean macroblock grid, True for blocks that overlap an exclusion zone"""
+        rows = (self.size[1] + MACROBLOCK_SIZE - 1) // MACROBLOCK_SIZE
+        cols = (self.size[0] + MACROBLOCK_SIZE - 1) // MACROBLOCK_SIZE
+        mask = np.zeros((rows, cols), bool)
+        # x_min..y_max bounds the top left corners of the timestamp's changing
+        # characters, so reach one macroblock further to cover the characters too.
+        zones = [[self.conf["x_min"], self.conf["y_min"],
+                  self.conf["x_max"] + self.scale_x, self.conf["y_max"] + self.scale_y]]
+        zones += self.conf.get("exclusion_zones", [])
+        for (x_min, y_min, x_max, y_max) in zones:
+            # Every block from the one holding the zone's top left corner to the
+            # one holding its bottom right corner.
+            mask[int(y_min // self.scale_y):int(y_max // self.scale_y) + 1,
+                 int(x_min // self.scale_x):int(x_max // self.scale_x) + 1] = True
+        return mask
+
+    def start(self):
+        """Start the encoder that produces the motion vectors"""
+        self.camera.start_recording('/dev/null', format='h264', splitter_port=MOTION_SPLITTER_PORT,
+                                    resize=self.size, motion_output=self)
+
+    def stop(self):
+        """Stop the motion vector encoder"""
+        self.camera.stop_recording(splitter_port=MOTION_SPLITTER_PORT)
+        if self.heatmap is not None:
+            self.heatmap.save()
+
+    def boxes_from_vectors(self, vectors):
+        """Return the motion boxes, in frame coordinates, for one frame's motion vectors"""
+        # There is an extra column of macroblocks on the right hand side that
+        # doesn't correspond to any part of the picture.
+        magnitude = motion_magnitude(vectors[:, :-1])
+        moving = magnitude >= self.conf["mv_magnitude"]
+        moving &= ~self.excluded
+        if self.heatmap is not None:
+            self.heatmap.add(moving.astype(np.uint8) * 255, magnitude)
+        boxes = []
+        for (col, row, cols, rows, blocks) in find_mask_blobs(moving):
+            if blocks * self.scale_x * self.scale_y < self.conf["min_area"]:
+                continue
+            boxes.append((int(col * self.scale_x), int(row * self.scale_y),
+                          int(cols * self.scale_x), int(rows * self.scale_y)))
+        return boxes
+
+    def analyze(self, a):
+        boxes = self.boxes_from_vectors(a)
+        with self.lock:
+            self.boxes = boxes
+
+    def detect(self, frame=None):
+        """Return the motion boxes of the latest encoded frame
+
+        Returns None until the encoder has delivered its first frame.
+        The frame isn't needed; it's only accepted to match FrameDiffDetector.
+        """
+        with self.lock:
+            return self.boxes
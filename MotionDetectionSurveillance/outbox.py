@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+#
+#           Event outbox.
+#
+# Lets other things on the box react when motion starts or a recording stops,
+# without the frame loop ever waiting on them.  post() just puts the event on an
+# in-memory queue.  A background thread takes events off the queue in batches,
+# appends them to a journal file on disk (so they survive a crash or restart),
+# and then delivers each batch to every sink configured in conf.json:
+#
+#   "outbox_journal": "/home/pi/Camera/MotionDetectionSurveillance/outbox.jsonl",
+#   "outbox_sinks": [
+#       {"type": "unix", "path": "/tmp/surveillance.sock"},    <- JSON lines to a Unix socket
+#       {"type": "http", "url": "http://localhost:8000/events"}, <- POST of a JSON list
+#       {"type": "script", "command": "/home/pi/on_motion.sh"}, <- JSON lines on stdin
+#       {"type": "file", "path": "/tmp/events.jsonl"}           <- appended JSON lines
+#   ]
+#
+# The file sink is handy as a stand in for the others when trying things out.
+# Leave outbox_sinks out (or empty) to turn the outbox off.
+#
+# If a sink fails, it is retried after 1, 2, 4, ... up to MAX_BACKOFF_SEC
+# seconds, and gets everything it missed once it's back.  How far each sink
+# has got through the journal is kept in the journal's ".offsets" file, and
+# the journal is emptied whenever every sink has caught up.
+#
+# If the outbox itself runs into trouble (the journal can't be written because
+# the SD card is full, say), it warns, keeps the events it has, and tries again
+# after the same kind of growing wait, rather than giving up.
+
+import json
+import os
+import queue
+import socket
+import subprocess
+import threading
+import time
+import urllib.request
+
+BATCH_SIZE = 50           # Most events to take off the queue at once.
+BATCH_WAIT_SEC = 1        # How long the sender waits for more events before delivering.
+SINK_TIMEOUT_SEC = 5      # How long to give a sink to take a batch.
+MAX_BACKOFF_SEC = 60      # Longest wait between retries of a failed sink.
+
+class UnixSocketSink:
+    """Send events as JSON lines to a Unix (stream) socket, one connection per batch"""
+
+    def __init__(self, path):
+        self.path = path
+        self.name = "unix:" + path
+
+    def send(self, events):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.settimeout(SINK_TIMEOUT_SEC)
+            s.connect(self.path)
+            s.sendall("".join(json.dumps(e) + "\n" for e in events).encode())
+
+class HttpSink:
+    """POST events as a JSON list to a (local) HTTP endpoint"""
+
+    def __init__(self, url):
+        self.url = url
+        self.name = "http:" + url
+
+    def send(self, events):
+        request = urllib.request.Request(self.url, data=json.dumps(events).encode(),
+                                         headers={"Content-Type": "application/json"})
+        urllib.request.urlopen(request, timeout=SINK_TIMEOUT_SEC).close()
+
+class ScriptSink:
+    """Run a command for each batch, with the events as JSON lines on its standard input"""
+
+    def __init__(self, command):
+        self.command = command
+        self.name = "script:" + command
+
+    def send(self, events):
+        subprocess.run(self.command, shell=True, check=True, timeout=SINK_TIMEOUT_SEC,
+                       input="".join(json.dumps(e) + "\n" for e in events).encode())
+
+class FileSink:
+    """Append events as JSON lines to a file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.name = "file:" + path
+
+    def send(self, events):
+        with open(self.path, "a") as f:
+            f.write("".join(json.dumps(e) + "\n" for e in events))
+
+def create_sink(sink_conf):
+    """Create a sink from its entry in outbox_sinks"""
+    kind = sink_conf["type"]
+    if kind == "unix":
+        return UnixSocketSink(sink_conf["path"])
+    elif kind == "http":
+        return HttpSink(sink_conf["url"])
+    elif kind == "script":
+        return ScriptSink(sink_conf["command"])
+    elif kind == "file":
+        return FileSink(sink_conf["path"])
+    else:
+        raise ValueError("Unexpected value for outbox sink type: ", kind)
+
+class EventOutbox:
+    """Queue events, journal them, and deliver them to the sinks from a background thread"""
+
+    def __init__(self, journal, sinks):
+        self.journal = journal
+        self.offsets_path = journal + ".offsets"
+        self.sinks = sinks
+        self.queue = queue.Queue()
+        self.unwritten = []  # Events taken off the queue but not yet in the journal.
+        self.stopping = threading.Event()
+        self.failures = {sink.name: 0 for sink in sinks}
+        self.retry_at = {sink.name: 0.0 for sink in sinks}
+
+        # Pick up where the last run left off.  A sink that wasn't there before
+        # starts from now, rather than getting the whole history.
+        size = self.repair_journal()
+        saved = {}
+        if os.path.exists(self.offsets_path):
+            with open(self.offsets_path) as f:
+                saved = json.load(f)
+        self.offsets = {}
+        for sink in sinks:
+            offset = saved.get(sink.name, size)
+            # An offset past the end means the journal was emptied just before
+            # a crash, before the offsets could be reset.
+            self.offsets[sink.name] = offset if offset <= size else 0
+
+        self.thread = threading.Thread(target=self.run, name="outbox", daemon=True)
+
+    def repair_journal(self):
+        """Drop any partly written last line (from a crash) from the journal, and return its size"""
+        if not os.path.exists(self.journal):
+            return 0
+        with open(self.journal, "rb+") as f:
+            data = f.read()
+            size = data.rfind(b"\n") + 1
+            if size < len(data):
+                f.truncate(size)
+        return size
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self, timeout=SINK_TIMEOUT_SEC):
+        """Deliver what's queued (giving up after timeout seconds) and stop the sender"""
+        self.stopping.set()
+        self.thread.join(timeout)
+
+    def post(self, event, **fields):
+        """Queue an event for delivery.  Never blocks."""
+        self.queue.put_nowait(dict(event=event, **fields))
+
+    def take_batch(self):
+        """Wait up to BATCH_WAIT_SEC for events, and return up to BATCH_SIZE of them"""
+        batch = []
+        try:
+            batch.append(self.queue.get(timeout=BATCH_WAIT_SEC))
+            while len(batch) < BATCH_SIZE:
+                batch.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def append_to_journal(self, batch):
+        # Anything that isn't JSON (a datetime, say) goes in as its str().
+        data = "".join(json.dumps(e, default=str) + "\n" for e in batch)
+        with open(self.journal, "a") as f:
+            start = f.tell()
+            try:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            except OSError:
+                # Don't leave half a batch behind to be written again after it.
+                f.truncate(start)
+                raise
+
+    def read_journal(self, offset):
+        """Return up to BATCH_SIZE events from the journal at offset on, and the offset after them"""
+        events = []
+        with open(self.journal, "rb") as f:
+            f.seek(offset)
+            for line in f:
+                if len(events) == BATCH_SIZE:
+                    break
+                offset += len(line)
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    print("[WARN] outbox skipping corrupt journal line: ", line)
+        return (events, offset)
+
+    def save_offsets(self):
+        tmp = self.offsets_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.offsets, f)
+        os.replace(tmp, self.offsets_path)
+
+    def deliver(self):
+        """Send each sink whatever it hasn't had yet, unless it's waiting to retry"""
+        if not os.path.exists(self.journal):
+            return
+        size = os.path.getsize(self.journal)
+        now = time.time()
+        for sink in self.sinks:
+            offset = self.offsets[sink.name]
+            if offset >= size or now < self.retry_at[sink.name]:
+                continue
+            (events, end) = self.read_journal(offset)
+            if not events:
+                continue
+            try:
+                sink.send(events)
+            except Exception as e:
+                self.failures[sink.name] += 1
+                backoff = min(MAX_BACKOFF_SEC, 2 ** (self.failures[sink.name] - 1))
+                self.retry_at[sink.name] = now + backoff
+                print("[WARN] outbox sink {} failed ({}), retrying in {} s".format(sink.name, e, backoff))
+                continue
+            self.failures[sink.name] = 0
+            self.offsets[sink.name] = end
+            self.save_offsets()
+
+        # Empty the journal once everyone has everything in it.
+        if size > 0 and all(offset >= size for offset in self.offsets.values()):
+            open(self.journal, "w").close()
+            self.offsets = {name: 0 for name in self.offsets}
+            self.save_offsets()
+
+    def run(self):
+        failures = 0
+        while True:
+            try:
+                self.unwritten.extend(self.take_batch())
+                if self.unwritten:
+                    self.append_to_journal(self.unwritten)
+                    self.unwritten = []
+                self.deliver()
+                failures = 0
+            except Exception as e:
+                failures += 1
+                backoff = min(MAX_BACKOFF_SEC, 2 ** (failures - 1))
+                print("[WARN] outbox failed ({}), {} events waiting, retrying in {} s".format(
+                    e, len(self.unwritten) + self.queue.qsize(), backoff))
+                # When stopping, don't hang around for things to get better.
+                if self.stopping.wait(backoff):
+                    break
+            if self.stopping.is_set() and self.queue.empty() and not self.unwritten:
+                break
+
+def create_outbox(conf):
+    """Create and start an EventOutbox if outbox_sinks is set in conf.json, otherwise return None"""
+    sinks = [create_sink(sink_conf) for sink_conf in conf.get("outbox_sinks", [])]
+    if not sinks:
+        return None
+    journal_dir = os.path.dirname(conf["outbox_journal"]) or "."
+    if not os.path.isdir(journal_dir):
+        raise ValueError("Directory for outbox_journal does not exist: ", journal_dir)
+    outbox = EventOutbox(conf["outbox_journal"], sinks)
+    outbox.start()
+    return outbox
@@ -0,0 +1,229 @@
+#!/usr/bin/python3
+# Offline re-analysis of recorded video.
+#
+# video_surveillance.py only looks for motion live, so if you change delta_thresh
+# or min_area in conf.json there is no way to tell what the new settings would
+# have caught (or missed) in the past.  This program decodes the .h264 files in
+# write_dir and runs the same motion detection over them, spread across all the
+# CPU cores, then writes the motion events it finds to an index file.
+#
+# Usage:
+#   python3 reanalyze.py --conf conf.json
+#   python3 reanalyze.py --conf conf.json --delta-thresh 8 --min-area 400 --index /tmp/index.json
+#
+# Each file is a separate job for the process pool.  If there are fewer files
+# than workers, long files are also split up, so that one long recording
+# doesn't leave the other cores idle.  The raw .h264 files can't be seeked by
+# frame number, so they are split by bytes instead, each piece starting at a
+# keyframe (picamera repeats the stream headers, SPS and PPS, before every
+# keyframe, so each piece can be decoded on its own).  Each piece is copied to
+# a temporary file (--tmp-dir) for the worker to decode; that's the price of
+# splitting, so it's only done when there are cores to spare.  Every frame is
+# decoded exactly once either way.
+#
+# Only the frame_diff detector can be used here, since the encoder's motion
+# vectors aren't saved with the video.
+#
+# The index is a JSON file with one entry per motion event:
+#   {"file": ..., "start": ..., "end": ..., "motion_frames": ..., "max_area": ...}
+# where start and end are the wall clock times (worked out from the file name
+# and the frame number) of the first and last frames with motion.  Frames with
+# motion less than idle_timeout apart are counted as the same event, just like
+# a live recording would have been kept going.
+from motion_detector import FRAME_WIDTH, FrameDiffDetector
+from multiprocessing import Pool, cpu_count
+import argparse
+import cv2
+import datetime
+import imutils
+import json
+import os
+import tempfile
+import time
+
+# Must match the file name format used in VideoRecorder.start().
+FILENAME_FORMAT = '%Y-%m-%d_%p_%I-%M-%S.h264'
+
+CHUNK_MB = 512         # Default size of a piece of a split file: about 4 minutes of video.
+SCAN_BLOCK = 1024 * 1024  # How much to read at a time when looking for a keyframe.
+
+def file_start_time(filename):
+    """Get the start time of a recording from its file name"""
+    return datetime.datetime.strptime(os.path.basename(filename), FILENAME_FORMAT)
+
+def is_sps(nal_header):
+    """True if an H.264 NAL unit header byte is for a sequence parameter set (type 7)"""
+    return nal_header & 0x1f == 7
+
+def find_keyframe(f, offset):
+    """Return the offset of the first stream headers (SPS) at or after offset in an open .h264 file, or None"""
+    start_code = b"\x00\x00\x00\x01"
+    f.seek(offset)
+    data = f.read(SCAN_BLOCK)
+    while data:
+        i = data.find(start_code)
+        while i != -1 and i + 4 < len(data):
+            if is_sps(data[i + 4]):
+                return offset + i
+            i = data.find(start_code, i + 1)
+        # Keep the last few bytes, in case a start code straddles the blocks.
+        keep = len(start_code)
+        more = f.read(SCAN_BLOCK)
+        if not more:
+            return None
+        offset += len(data) - keep
+        data = data[-keep:] + more
+    return None
+
+def plan_jobs(paths, workers, chunk_bytes):
+    """Split the files into (path, start byte, end byte) jobs for the pool
+
+    end is None for "to the end of the file".  Files are only split when there
+    are fewer of them than workers.
+    """
+    jobs = []
+    for path in paths:
+        size = os.path.getsize(path)
+        if len(paths) >= workers or chunk_bytes <= 0 or size <= chunk_bytes:
+            jobs.append((path, 0, None))
+            continue
+        starts = [0]
+        with open(path, "rb") as f:
+            for target in range(chunk_bytes, size, chunk_bytes):
+                start = find_keyframe(f, max(target, starts[-1] + 1))
+                if start is None:
+                    break
+                if start > starts[-1]:
+                    starts.append(start)
+        ends = starts[1:] + [None]
+        jobs.extend((path, start, end) for (start, end) in zip(starts, ends))
+    return jobs
+
+def copy_piece(path, start, end, tmp_dir):
+    """Copy bytes start..end of a file to a temporary .h264 file, and return its name"""
+    (fd, piece) = tempfile.mkstemp(suffix=".h264", dir=tmp_dir)
+    with open(path, "rb") as src, os.fdopen(fd, "wb") as dst:
+        src.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            data = src.read(min(SCAN_BLOCK * 16, remaining))
+            if not data:
+                break
+            dst.write(data)
+            remaining -= len(data)
+    return piece
+
+def analyze_chunk(job):
+    """Run motion detection over one file, or piece of a file
+
+    Returns (path, start byte, frames, motion), where motion is a list of
+    (frame_number, total_area) for the frames that had motion, numbered from
+    the start of the piece.  Runs in a pool worker process.
+    """
+    path, start, end, conf, tmp_dir = job
+    piece = None
+    if start > 0 or end is not None:
+        piece = copy_piece(path, start, end if end is not None else os.path.getsize(path), tmp_dir)
+    detector = FrameDiffDetector(conf)
+    cap = cv2.VideoCapture(piece or path)
+
+    frames = 0
+    motion = []
+    while True:
+        (grabbed, frame) = cap.read()
+        if not grabbed:
+            break
+        frame = imutils.resize(frame, width=FRAME_WIDTH)
+        boxes = detector.detect(frame)
+        if boxes:
+            motion.append((frames, sum(w * h for (x, y, w, h) in boxes)))
+        frames += 1
+    cap.release()
+    if piece is not None:
+        os.remove(piece)
+    return (path, start, frames, motion)
+
+def group_events(path, motion, conf):
+    """Group one file's motion frames into events, as for the index"""
+    start_time = file_start_time(path)
+    gap_frames = conf["idle_timeout"] * conf["fps"]
+    events = []
+    for (frame_number, area) in sorted(motion):
+        if events and frame_number - events[-1]["last_frame"] <= gap_frames:
+            event = events[-1]
+            event["last_frame"] = frame_number
+            event["motion_frames"] += 1
+            event["max_area"] = max(event["max_area"], area)
+        else:
+            events.append({"file": os.path.basename(path), "first_frame": frame_number,
+                           "last_frame": frame_number, "motion_frames": 1, "max_area": area})
+    for event in events:
+        first = event.pop("first_frame")
+        last = event.pop("last_frame")
+        event["start"] = (start_time + datetime.timedelta(seconds=first / conf["fps"])).isoformat()
+        event["end"] = (start_time + datetime.timedelta(seconds=last / conf["fps"])).isoformat()
+    return events
+
+def main():
+    # Construct the argument parser and parse the arguments.
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-c", "--conf", required=True, help="Path to the JSON configuration file")
+    ap.add_argument("--delta-thresh", type=int, help="Override delta_thresh from the configuration file")
+    ap.add_argument("--min-area", type=int, help="Override min_area from the configuration file")
+    ap.add_argument("--dir", help="Directory of videos to analyze (default: write_dir)")
+    ap.add_argument("--index", help="File to write the motion events to (default: motion_index.json in the videos directory)")
+    ap.add_argument("--workers", type=int, default=cpu_count(), help="Number of worker processes")
+    ap.add_argument("--chunk-mb", type=int, default=CHUNK_MB, help="Size of the pieces to split files into, when there are spare workers (0 not to)")
+    ap.add_argument("--tmp-dir", help="Where to put the pieces of split files (default: the system temporary directory)")
+    args = vars(ap.parse_args())
+
+    # Load the configuration, with any overrides.
+    conf = json.load(open(args["conf"]))
+    if args["delta_thresh"] is not None:
+        conf["delta_thresh"] = args["delta_thresh"]
+    if args["min_area"] is not None:
+        conf["min_area"] = args["min_area"]
+    # Leave the live activity heatmap alone.
+    conf["heatmap_file"] = None
+    if conf.get("detector", "frame_diff") != "frame_diff":
+        print("[INFO] motion vectors aren't saved with the video, using frame_diff")
+
+    videos_dir = args["dir"] or conf["write_dir"]
+    index = args["index"] or os.path.join(videos_dir, "motion_index.json")
+    paths = [os.path.join(videos_dir, fn) for fn in sorted(os.listdir(videos_dir)) if fn.endswith(".h264")]
+
+    jobs = plan_jobs(paths, args["workers"], args["chunk_mb"] * 1024 * 1024)
+    workers = max(min(args["workers"], len(jobs)), 1)
+    print("[INFO] {} files, {} jobs, {} workers".format(len(paths), len(jobs), workers))
+
+    # One file (or piece) per worker, results collected per file as they finish.
+    start = time.time()
+    results = {path: [] for path in paths}
+    with Pool(workers) as pool:
+        for (path, piece_start, piece_frames, piece_motion) in pool.imap_unordered(
+                analyze_chunk, [job + (conf, args["tmp_dir"]) for job in jobs]):
+            results[path].append((piece_start, piece_frames, piece_motion))
+    elapsed = time.time() - start
+
+    # Put each file's pieces back in order, numbering their frames from the
+    # start of the file.
+    frames = 0
+    events = []
+    for path in paths:
+        motion = []
+        offset = 0
+        for (piece_start, piece_frames, piece_motion) in sorted(results[path], key=lambda r: r[0]):
+            motion.extend((frame_number + offset, area) for (frame_number, area) in piece_motion)
+            offset += piece_frames
+        frames += offset
+        events.extend(group_events(path, motion, conf))
+    with open(index, "w") as f:
+        json.dump(events, f, indent=1)
+
+    fps = frames / elapsed if elapsed > 0 else 0
+    print("[INFO] {} motion events written to {}".format(len(events), index))
+    print("[INFO] {} frames in {:.1f} s: {:.1f} frames/sec, {:.1f} frames/sec per core".format(
+        frames, elapsed, fps, fps / workers))
+
+if __name__ == "__main__":
+    main()
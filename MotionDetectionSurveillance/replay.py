@@ -0,0 +1,264 @@
+#!/usr/bin/python3
+# Faster than real time replay of scripted scenes.
+#
+# The recording logic depends on the time of day, idle_timeout and timers, so
+# trying out a change by waiting for something to happen in front of the camera
+# takes forever.  This runs the same state machine (surveillance.py) and
+# VideoRecorder, but on a virtual clock (see clock.py), with a fake camera that
+# just writes empty (sparse) files of the right size to a temporary directory
+# standing in for the disk.  So a whole night goes by in a few seconds, and the
+# annotation timer, file naming and ensure_space evictions all happen as they
+# would for real.
+#
+# A scene script is a JSON list of segments, played in order:
+#   [{"seconds": 3600},                                  <- an hour of nothing
+#    {"seconds": 20, "boxes": [[300, 200, 80, 60]]},     <- 20 s of motion there
+#    ...]
+# "boxes" are what the detector would have reported for every frame of the
+# segment.  Add "repeat": n to play a segment n times over.  To repeat a few
+# segments in turn, put them in a group:
+#   {"repeat": 20, "scenes": [{"seconds": 2, "boxes": [...]}, {"seconds": 8}]}
+#
+# To try out the detector itself, give a segment "frames" too:
+#   {"seconds": 600, "frames": {"brightness": 15, "noise": 12}, "boxes": [...]}
+# Then made up frames of that brightness, with that much (Gaussian) sensor noise,
+# and a bright, jiggling rectangle for each box, go through the frame_diff
+# detector, and what it finds drives the recording.  That's a lot slower, so
+# use a low --fps (the real frame loop only manages a few frames a second
+# anyway).  brightness and noise can also be given as [start, end], to change
+# steadily over the segment, as at dusk and dawn.  ir_night_scenes.json is an
+# example.
+#
+# Usage:
+#   python3 replay.py --conf conf.json                  (plays DEMO_SCENES)
+#   python3 replay.py --conf conf.json --scenes night.json --disk-gb 40
+#   python3 replay.py --conf conf.json --scenes ir_night_scenes.json --fps 2
+#   python3 replay.py --conf conf.json --scenes ir_night_scenes.json --fps 2 --fixed-thresh
+#   python3 replay.py --conf conf.json --events /tmp/events.jsonl
+#
+# With --events, the outbox events (see outbox.py) go to that file, through a
+# real EventOutbox and its journal, instead of to the outbox_sinks in conf.json.
+#
+# At the end it reports the recordings made, how long they were, the gaps
+# between them, how many were deleted to make room, how many were false
+# triggers (started when the script had no motion going on), and how much was
+# recorded while the script had no motion going on.  That last one is the
+# real cost of false triggers: one that never stops is a single trigger, but
+# hours of video.
+from clock import VirtualClock
+from motion_detector import FRAME_WIDTH, FrameDiffDetector
+from outbox import EventOutbox, FileSink
+from surveillance import Surveillance
+from video_recorder import VideoRecorder
+import argparse
+import contextlib
+import cv2
+import datetime
+import io
+import json
+import numpy as np
+import os
+import tempfile
+import time
+
+BYTES_PER_HOUR = 7.2 * 1024 ** 3  # About what the real camera writes (see video_recorder.py).
+BOX_JIGGLE = 10      # Pixels the rectangles move back and forth, so they keep showing as motion.
+NOISE_GRAIN = 16     # Size, in pixels, of the blotches of made up sensor noise.
+FRAME_BANK_SIZE = 8  # Frames of made up noise, cycled through.
+
+# A night with a few comings and goings, for when no scene script is given.
+DEMO_SCENES = [
+    {"seconds": 1800},
+    {"seconds": 15, "boxes": [[300, 200, 80, 60]]},   # Someone walks past
+    {"seconds": 5},
+    {"seconds": 10, "boxes": [[500, 250, 120, 80]]},  # and back again
+    {"seconds": 7200},
+    {"repeat": 20, "scenes": [                        # A cat, on and off
+        {"seconds": 2, "boxes": [[100, 400, 30, 30]]},
+        {"seconds": 8}]},
+    {"seconds": 14400},
+    {"seconds": 120, "boxes": [[0, 300, 400, 200]]},  # The paper being delivered
+    {"seconds": 3600},
+]
+
+class FakeCamera:
+    """Stands in for the PiCamera, writing a sparse file of the right size for each recording"""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.annotate_text = ""
+        self.annotate_background = None
+        self.path = None
+        self.started = None
+        self.recordings = []  # (file name, start time, seconds)
+
+    def start_recording(self, path, **kwargs):
+        self.path = path
+        self.started = self.clock.now()
+
+    def wait_recording(self, timeout=0):
+        pass
+
+    def stop_recording(self, **kwargs):
+        seconds = (self.clock.now() - self.started).total_seconds()
+        with open(self.path, "wb") as f:
+            f.truncate(int(seconds * BYTES_PER_HOUR / 3600))
+        self.recordings.append((os.path.basename(self.path), self.started, seconds))
+        self.path = None
+
+class ReplayRecorder(VideoRecorder):
+    """VideoRecorder on a pretend disk of disk_GB, rather than the real free space"""
+
+    disk_GB = 100
+
+    @classmethod
+    def get_free_space_GB(cls, dir):
+        used = sum(os.path.getsize(os.path.join(dir, fn)) for fn in os.listdir(dir))
+        return cls.disk_GB - used / (1024 ** 3)
+
+def noise_bank(height):
+    """Make FRAME_BANK_SIZE frames of unit (Gaussian) noise, at 1/NOISE_GRAIN the frame size
+
+    Scaling the noise up to the frame size later makes it come in blotches, like
+    the real thing at night, rather than single pixels that the detector's blur
+    would just wipe out.
+    """
+    return np.random.RandomState(0).normal(0, 1, (FRAME_BANK_SIZE, height // NOISE_GRAIN, FRAME_WIDTH // NOISE_GRAIN))
+
+def ramp(value, fraction):
+    """A scene value that is either fixed, or [start, end] to change steadily over the segment"""
+    if isinstance(value, list):
+        return value[0] + (value[1] - value[0]) * fraction
+    return value
+
+def make_frame(noise, frames, fraction, height):
+    """Make a frame of a segment's "frames" lighting, fraction of the way through it"""
+    gray = np.clip(noise * ramp(frames["noise"], fraction) + ramp(frames["brightness"], fraction), 0, 255)
+    return cv2.cvtColor(cv2.resize(gray.astype(np.uint8), (FRAME_WIDTH, height)), cv2.COLOR_GRAY2BGR)
+
+def segments(scenes):
+    """Generate the segments of a scene script in the order they are played, groups and repeats unrolled"""
+    for scene in scenes:
+        for _ in range(scene.get("repeat", 1)):
+            if "scenes" in scene:
+                yield from segments(scene["scenes"])
+            else:
+                yield scene
+
+def play(scenes, surveillance, clock, fps, conf, detector=None):
+    """Feed the scene script to the state machine, a frame at a time
+
+    Returns the (start, end) times of the segments that had motion.
+    """
+    step = 1.0 / fps
+    height = int(FRAME_WIDTH * conf["resolution"][1] / conf["resolution"][0])
+    noise = noise_bank(height)
+    motion_periods = []
+    frame_number = 0
+    for scene in segments(scenes):
+        boxes = [tuple(b) for b in scene.get("boxes", [])]
+        frames = int(scene["seconds"] * fps)
+        start = clock.now()
+        for i in range(frames):
+            clock.advance(step)
+            if detector is None or "frames" not in scene:
+                detected = boxes
+            else:
+                frame = make_frame(noise[frame_number % FRAME_BANK_SIZE], scene["frames"], i / frames, height)
+                shift = (frame_number % 2) * BOX_JIGGLE
+                for (x, y, w, h) in boxes:
+                    cv2.rectangle(frame, (x + shift, y), (x + shift + w, y + h), (255, 255, 255), -1)
+                detected = detector.detect(frame) or []
+            surveillance.update(detected)
+            frame_number += 1
+        if boxes:
+            motion_periods.append((start, clock.now()))
+    return motion_periods
+
+def seconds_outside(start, end, motion_periods):
+    """Seconds from start to end that aren't in any of the (start, end) motion periods"""
+    seconds = (end - start).total_seconds()
+    for (p_start, p_end) in motion_periods:
+        overlap = (min(end, p_end) - max(start, p_start)).total_seconds()
+        if overlap > 0:
+            seconds -= overlap
+    return seconds
+
+def report(recordings, remaining, motion_periods, elapsed, simulated):
+    print("Recordings made: {}".format(len(recordings)))
+    previous_end = None
+    false_triggers = 0
+    outside = 0
+    for (fn, start, seconds) in recordings:
+        gap = ""
+        if previous_end is not None:
+            gap = "  (gap {:.0f} s)".format((start - previous_end).total_seconds())
+        kept = "" if fn in remaining else "  [deleted for space]"
+        false = ""
+        if not any(p_start <= start <= p_end for (p_start, p_end) in motion_periods):
+            false_triggers += 1
+            false = "  [false trigger]"
+        print("  {}  {:7.1f} s{}{}{}".format(fn, seconds, gap, kept, false))
+        previous_end = start + datetime.timedelta(seconds=seconds)
+        outside += seconds_outside(start, previous_end, motion_periods)
+    total = sum(seconds for (_, _, seconds) in recordings)
+    print("Total recorded: {:.0f} s, {:.2f} GB written".format(total, total * BYTES_PER_HOUR / 3600 / (1024 ** 3)))
+    print("Deleted for space: {}".format(sum(1 for (fn, _, _) in recordings if fn not in remaining)))
+    print("False triggers: {} ({:.1f} per hour)".format(false_triggers, false_triggers * 3600 / simulated))
+    print("Recorded with no motion going on: {:.0f} s, {:.2f} GB (including the idle_timeout after each motion)".format(
+        outside, outside * BYTES_PER_HOUR / 3600 / (1024 ** 3)))
+    print("Replayed {:.1f} hours in {:.1f} s".format(simulated / 3600, elapsed))
+
+def main():
+    # Construct the argument parser and parse the arguments.
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-c", "--conf", required=True, help="Path to the JSON configuration file")
+    ap.add_argument("--scenes", help="Scene script (default: a built in demo night)")
+    ap.add_argument("--start", default="2018-10-20T21:00:00", help="Virtual start time")
+    ap.add_argument("--fps", type=float, help="Frames per second to replay at (default: fps from the configuration file)")
+    ap.add_argument("--disk-gb", type=float, default=100, help="Size of the pretend disk")
+    ap.add_argument("--fixed-thresh", action="store_true", help="Turn adaptive_thresh off, for comparison")
+    ap.add_argument("--events", help="File to write the outbox events to")
+    ap.add_argument("--verbose", action="store_true", help="Show the recorder's and detector's own messages")
+    args = vars(ap.parse_args())
+    # ensure_space deletes recordings until there is FREE_SPACE_GB free, which a
+    # disk no bigger than that never has.
+    if args["disk_gb"] <= ReplayRecorder.FREE_SPACE_GB:
+        ap.error("--disk-gb must be more than FREE_SPACE_GB ({} GB) in video_recorder.py".format(
+            ReplayRecorder.FREE_SPACE_GB))
+
+    conf = json.load(open(args["conf"]))
+    # Leave the live activity heatmap alone.
+    conf["heatmap_file"] = None
+    if args["fixed_thresh"]:
+        conf["adaptive_thresh"] = False
+    scenes = json.load(open(args["scenes"])) if args["scenes"] else DEMO_SCENES
+    fps = args["fps"] or conf["fps"]
+
+    clock = VirtualClock(datetime.datetime.strptime(args["start"], "%Y-%m-%dT%H:%M:%S"))
+    camera = FakeCamera(clock)
+    ReplayRecorder.set_clock(clock)
+    ReplayRecorder.set_camera(camera)
+    ReplayRecorder.disk_GB = args["disk_gb"]
+    outbox = None
+    if args["events"]:
+        outbox = EventOutbox(args["events"] + ".journal", [FileSink(args["events"])])
+        outbox.start()
+    surveillance = Surveillance(conf, ReplayRecorder, clock, outbox)
+
+    with tempfile.TemporaryDirectory() as videos_dir:
+        ReplayRecorder.set_videos_dir(videos_dir + os.sep)
+        started = time.time()
+        start_time = clock.now()
+        output = contextlib.nullcontext() if args["verbose"] else contextlib.redirect_stdout(io.StringIO())
+        with output:
+            motion_periods = play(scenes, surveillance, clock, fps, conf, FrameDiffDetector(conf))
+            surveillance.quit()
+            if outbox is not None:
+                outbox.stop()
+        elapsed = time.time() - started
+        remaining = set(os.listdir(videos_dir))
+    report(camera.recordings, remaining, motion_periods, elapsed, (clock.now() - start_time).total_seconds())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+#
+#           Surveillance state machine.
+#
+# Decides, frame by frame, from the motion boxes the detector found, when to
+# start and stop recording.  video_surveillance.py feeds it frames from the
+# camera; replay.py feeds it scripted scenes on a virtual clock.
+
+from enum import Enum
+import datetime
+
+# Enumeration for the possible states of the system.  It starts out IDLE.
+# When a frame is determined to have motion, it goes to ACTIVE.
+# At the next frame that has no motion, it goes to RECORDING.
+# After a certain amount of time (idle_timeout in conf.json), if no further
+# motion has been detected, it will go to IDLE.
+class State(Enum):
+    IDLE =  0
+    RECORDING = 1
+    ACTIVE = 2
+
+class Surveillance:
+    """Start and stop the recorder as motion comes and goes
+
+    recorder is the VideoRecorder class (or a stand in with the same start() and
+    stop(), and a filename attribute for the current recording's path), and
+    clock a clock from clock.py.  If there is an outbox (see outbox.py),
+    "motion_started" and "recording_stopped" events are posted to it, with
+    the recorder's filename.
+    """
+
+    def __init__(self, conf, recorder, clock, outbox=None):
+        self.conf = conf
+        self.recorder = recorder
+        self.clock = clock
+        self.outbox = outbox
+        # Start out in the IDLE state.
+        self.state = State.IDLE
+        # Initialize to a long time ago (in a galaxy far, far away...).
+        self.last_active_time = datetime.datetime(datetime.MINYEAR, 1, 1)
+
+    def update(self, boxes):
+        """Update the state for a frame with the given motion boxes, and return it"""
+        # Figure out the new state.  Start by assuming no motion is detected, so
+        # set the new state to either IDLE or RECORDING, depending on time since
+        # motion was last detected.  Then the loop can overwrite the state with
+        # ACTIVE if any adequate contours were found.
+        timestamp = self.clock.now()
+        # If it's been longer than idle_timeout since the scene has had activity,
+        # set the text to Idle, otherwise, Idle, Recording.
+        elapsed_time = timestamp - self.last_active_time
+        if elapsed_time.total_seconds() > self.conf["idle_timeout"]:
+            new_state = State.IDLE
+        else:
+            new_state = State.RECORDING
+
+        if boxes:
+            new_state = State.ACTIVE
+            # Update the last_active_time to now (keep the recording going).
+            self.last_active_time = timestamp
+
+        if new_state == State.ACTIVE:
+            # Motion has been detected, so the scene is now ACTIVE.
+            if self.state == State.IDLE:
+                # Transitioning from IDLE to ACTIVE, so we need to start recording.
+                self.recorder.start()
+                self.post("motion_started", timestamp, boxes=[list(b) for b in boxes])
+            self.state = State.ACTIVE
+
+        elif new_state == State.RECORDING:
+            self.state = State.RECORDING
+
+        elif new_state == State.IDLE:
+            if self.state != State.IDLE:
+                # Transitioning from RECORDING to IDLE.  Stop the recording.
+                self.state = State.IDLE
+                self.recorder.stop()
+                self.post("recording_stopped", timestamp)
+
+        return self.state
+
+    def post(self, event, timestamp, **fields):
+        """Post an event about the current recording to the outbox, if there is one"""
+        if self.outbox is not None:
+            self.outbox.post(event, time=timestamp.isoformat(), file=self.recorder.filename, **fields)
+
+    def quit(self):
+        """Stop any recording in progress"""
+        if self.state != State.IDLE:
+            self.recorder.stop()
+            self.state = State.IDLE
+            self.post("recording_stopped", self.clock.now())
@@ -27,10 +27,14 @@
 # but it will be overwritten by what's in conf.json, so you really need to
 # change it there.
 
-import datetime
+from clock import WallClock
 import json
 import os
-import picamera
+try:
+    import picamera
+except ImportError:
+    # Only needed for the real camera, not the fake one in replay.py.
+    picamera = None
 try:
     import rainbowhat
     rh_found = True
@@ -38,7 +42,6 @@ except ImportError:
     rh_found = False
 import signal
 import sys
-from threading import Timer
 from time import sleep
 
 class VideoRecorder:
@@ -57,7 +60,10 @@ class VideoRecorder:
                                   
     camera = None
     recording = False
+    filename = None                # Full path of the current (or last) recording
     annotation_timer = None        # Timer to update the time annotation in the video
+    clock = WallClock()            # A call to set_clock will overwrite this
+    quit_callback = None           # A call to set_quit_callback will overwrite this
     videos_dir = VIDEOS_DIRECTORY  # A call to set_videos_dir will overwrite this
 
     if rh_found:
@@ -73,6 +79,30 @@ class VideoRecorder:
         """
         cls.camera = cam
 
+    @classmethod
+    def set_clock(cls, clock):
+        """Set the clock used for timestamps, file names and timers (see clock.py)"""
+        cls.clock = clock
+
+    @classmethod
+    def set_quit_callback(cls, callback):
+        """Set the function the quit buttons call to shut everything down
+
+        video_surveillance.py owns the state machine, detector and outbox, which
+        need stopping too, not just the recording.
+        """
+        cls.quit_callback = callback
+
+    @classmethod
+    def shut_down(cls):
+        """Stop everything, through the quit callback if there is one"""
+        if cls.quit_callback is not None:
+            cls.quit_callback()
+        else:
+            if cls.recording:
+                cls.stop()
+            cls.quit()
+
     @classmethod
     def set_videos_dir(cls, dir):
         """Change the videos director from the hard coded default"""
@@ -108,9 +138,9 @@ class VideoRecorder:
     def update_time_annotation(cls):
         """Update the annotation time in the video, and start a new timer for the next update"""
         if cls.recording:
-            cls.camera.annotate_text = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            cls.camera.annotate_text = cls.clock.now().strftime('%Y-%m-%d %H:%M:%S')
             cls.camera.wait_recording(0)
-            cls.annotation_timer = Timer(cls.ANNOTATION_TIMER_INTERVAL_SEC, cls.update_time_annotation)
+            cls.annotation_timer = cls.clock.timer(cls.ANNOTATION_TIMER_INTERVAL_SEC, cls.update_time_annotation)
             cls.annotation_timer.start()
 
     @classmethod
@@ -118,7 +148,7 @@ class VideoRecorder:
         """Start a recording"""
         cls.ensure_space(cls.videos_dir)
         cls.recording = True
-        now = datetime.datetime.now()
+        now = cls.clock.now()
 
         fn = now.strftime('%Y-%m-%d_%p_%I-%M-%S.h264')
     
@@ -127,10 +157,12 @@ class VideoRecorder:
         print('File name: ', fn)
         print('Full path filename: ', fullPathFilename)
 
-        cls.camera.annotate_background = picamera.Color('black')
-        cls.camera.annotate_text = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        if picamera is not None:
+            cls.camera.annotate_background = picamera.Color('black')
+        cls.camera.annotate_text = now.strftime('%Y-%m-%d %H:%M:%S')
         cls.camera.start_recording(fullPathFilename)
-        cls.annotation_timer = Timer(cls.ANNOTATION_TIMER_INTERVAL_SEC, cls.update_time_annotation)
+        cls.filename = fullPathFilename
+        cls.annotation_timer = cls.clock.timer(cls.ANNOTATION_TIMER_INTERVAL_SEC, cls.update_time_annotation)
         cls.annotation_timer.start()
         print('Starting recording')
         if rh_found:
@@ -176,9 +208,7 @@ if rh_found:
             # Play a tone, slightly different for each button.
             beep(channel * 5)
         
-            if VideoRecorder.recording:
-                VideoRecorder.stop()
-            VideoRecorder.quit()
+            VideoRecorder.shut_down()
             print('Exiting')
             sys.exit(0)
     
@@ -187,16 +217,12 @@ if rh_found:
             # Play a tone, slightly different for each button.
             beep(channel * 5)
             
-            if VideoRecorder.recording:
-                VideoRecorder.stop()
-            VideoRecorder.quit()
+            VideoRecorder.shut_down()
             os.system(command)
             exit(0)
             
         if channel > 2:
             print('Unexpected button touched!  How did that happen?!')
-            if VideoRecorder.recording:
-                VideoRecorder.stop()
-            VideoRecorder.quit()
+            VideoRecorder.shut_down()
             print('Exiting')
             raise ValueError("Bad value for channel.  No such button!")
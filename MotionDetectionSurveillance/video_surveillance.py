@@ -9,6 +9,15 @@
 # Directory structure:
 # |--- video_surveillance.py
 # |--- video_recorder.py
+# |--- surveillance.py       (the IDLE/ACTIVE/RECORDING state machine)
+# |--- motion_detector.py    (motion detector backends)
+# |--- motion_vectors.py
+# |--- heatmap.py
+# |--- clock.py
+# |--- reanalyze.py          (offline re-analysis of recorded video)
+# |--- heatmap_report.py     (suggests exclusion zones and thresholds)
+# |--- replay.py             (faster than real time replay of scripted scenes)
+# |--- outbox.py             (event notifications for other programs)
 # |--- conf.json
 # |--- pyimagesearch
 # |    |--- __init__.py
@@ -26,6 +35,14 @@
 #     min_area can be tweaked to control how small an area of motion
 #       you want to trigger recording.  A setting of 100 results in motion detection being
 #       triggered by large snowflakes!  You may or may not be down with that.
+#     detector selects how motion is found: "frame_diff" (the original, CPU heavy, frame
+#       differencing) or "motion_vectors" (uses the H.264 encoder's motion vectors, with
+#       mv_magnitude as the minimum vector length and mv_resolution as the size of the
+#       stream they come from).  See motion_detector.py and motion_vectors.py.
+#     adaptive_thresh makes frame_diff raise delta_thresh to noise_factor times the measured
+#       noise level, and use day_alpha or night_alpha (below night_brightness) as the
+#       background learning rate, so the noisy NoIR night time picture doesn't keep triggering
+#       recordings.  See AdaptiveThreshold in motion_detector.py.
 #     NOTE:  If you change the values for resolution, you will need to make corresponding
 #     changes to x_min, x_max, y_min, and y_max (largely by trial and error.  You may want
 #     to temporarily uncomment the following line below: #print("x:", x, "y:", y, "w:", w, "h:", h))
@@ -33,33 +50,20 @@
 # Detection of motion is used to start a video recording.  After a certain amount of time since
 # the last detection of motion, it will time out and end the recording.  Filenames are the time
 # of the start of each recording.
-from enum import Enum
 from picamera import PiCamera
 from picamera.array import PiRGBArray
 from pyimagesearch.tempimage import TempImage
 from video_recorder import VideoRecorder
+from motion_detector import FRAME_WIDTH, create_detector
+from motion_vectors import MOTION_SPLITTER_PORT
+from outbox import create_outbox
+from surveillance import State, Surveillance
 import argparse
 import cv2
-import datetime
-import enum
-import imutils
 import json
 import time
 import warnings
  
-# Enumeration for the possible states of the system.  It starts out IDLE.
-# When a frame is determined to have motion, it goes to ACTIVE.
-# At the next frame that has no motion, it goes to RECORDING.
-# After a certain amount of time (idle_timeout in conf.json), if no further
-# motion has been detected, it will go to IDLE.
-class State(Enum):
-    IDLE =  0
-    RECORDING = 1
-    ACTIVE = 2
-
-# Start out in the IDLE state.
-state = State.IDLE
-  
 # Construct the argument parser and parse the arguments.
 ap = argparse.ArgumentParser()
 ap.add_argument("-c", "--conf", required=True,	help="Path to the JSON configuration file")
@@ -76,7 +80,11 @@ conf = json.load(open(args["conf"]))
 camera = PiCamera()
 camera.resolution = tuple(conf["resolution"])
 camera.framerate = conf["fps"]
-rawCapture = PiRGBArray(camera, size=tuple(conf["resolution"]))
+
+# Frames are captured already scaled down to FRAME_WIDTH by the GPU, rather
+# than at full resolution and then resized on the CPU.
+frame_size = (FRAME_WIDTH, int(FRAME_WIDTH * conf["resolution"][1] / conf["resolution"][0]))
+rawCapture = PiRGBArray(camera, size=frame_size)
  
 # Pass the camera object to the Video Recorder.
 VideoRecorder.set_camera(camera)
@@ -88,105 +96,63 @@ VideoRecorder.set_videos_dir(conf["write_dir"])
 # uploaded timestamp, and frame motion counter.
 print("[INFO] warming up...")
 time.sleep(conf["camera_warmup_time"])
-avg = None
 
-# Initialize to a long time ago (in a galaxy far, far away...).
-last_active_time = datetime.datetime(datetime.MINYEAR, 1, 1)
+# Create the motion detector backend selected in conf.json.
+detector = create_detector(conf, camera)
+detector.start()
 
-# Get the min and max x and y values for the timestamp exclusion
-# code below.  If the resolution is changed in the conf.json file,
-# these need to be adjusted as well.  
-x_min = conf["x_min"]
-x_max = conf["x_max"]
-y_min = conf["y_min"]
-y_max = conf["y_max"]
+# Start the event outbox, if any outbox_sinks are set in conf.json (see outbox.py).
+outbox = create_outbox(conf)
 
-# Capture frames from the camera (endless loop, till quit).
-for f in camera.capture_continuous(rawCapture, format="bgr", use_video_port=True):
-    # Grab the raw NumPy array representing the image and initialize
-    # the timestamp and active/idle text.
-    frame = f.array
+# The state machine that starts and stops the recordings (see surveillance.py).
+surveillance = Surveillance(conf, VideoRecorder, VideoRecorder.clock, outbox)
 
-    # Resize the frame, convert it to grayscale, and blur it.
-    frame = imutils.resize(frame, width=960)
-    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-    gray = cv2.GaussianBlur(gray, (21, 21), 0)
- 
-    # If the average frame is None, initialize it
-    if avg is None:
-        print("[INFO] starting background model...")
-        avg = gray.copy().astype("float")
+def shut_down():
+    """Stop the recording, detector and outbox, for the q key and the Rainbow Hat's quit buttons"""
+    surveillance.quit()
+    VideoRecorder.quit()
+    detector.stop()
+    if outbox is not None:
+        outbox.stop()
+
+VideoRecorder.set_quit_callback(shut_down)
+
+def frames():
+    """Generate the frames to look at (endless, till quit)
+
+    The motion_vectors detector doesn't need frames at all, so unless they are to
+    be shown, don't capture any; just go round once per frame the encoder does.
+    """
+    if conf.get("detector") == "motion_vectors" and not conf["show_video"]:
+        while True:
+            camera.wait_recording(1.0 / conf["fps"], splitter_port=MOTION_SPLITTER_PORT)
+            yield None
+    for f in camera.capture_continuous(rawCapture, format="bgr", use_video_port=True,
+                                       resize=frame_size):
+        # Grab the raw NumPy array representing the image.
+        yield f.array
+        # Clear the stream in preparation for the next frame.
         rawCapture.truncate(0)
-        continue
+
+for frame in frames():
+    # Look for motion in the frame.
+    boxes = detector.detect(frame)
  
-    # Accumulate the weighted average between the current frame and
-    # previous frames, then compute the difference between the current
-    # frame and running average.
-    cv2.accumulateWeighted(gray, avg, 0.5)
-    frameDelta = cv2.absdiff(gray, cv2.convertScaleAbs(avg))
-	
-    # Threshold the delta image, dilate the thresholded image to fill
-    # in holes, then find contours on thresholded image
-    thresh = cv2.threshold(frameDelta, conf["delta_thresh"], 255, cv2.THRESH_BINARY)[1]
-    thresh = cv2.dilate(thresh, None, iterations=2)
-    cnts = cv2.findContours(thresh.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    cnts = cnts[0] if imutils.is_cv2() else cnts[1]
+    # If the detector has no background model yet, there's nothing to go on.
+    if boxes is None:
+        continue
  
-    # Figure out the new state.  Start by assuming no motion is detected, so
-    # set the new state to either IDLE or RECORDING, depending on time since
-    # motion was last detected.  Then the loop can overwrite the state with
-    # ACTIVE if any adequate contours were found.
-    timestamp = datetime.datetime.now()
-    # If it's been longer than idle_timeout since the scene has had activity,
-    # set the text to Idle, otherwise, Idle, Recording.
-    elapsed_time = timestamp - last_active_time
-    if elapsed_time.seconds > conf["idle_timeout"]:
-        new_state = State.IDLE
-    else:
-        new_state = State.RECORDING
-        
-    # Loop over the contours.
-    for c in cnts:
-        # If the contour is too small, ignore it.
-        # This is a value you may want to tweak to your own preference.
-        if cv2.contourArea(c) < conf["min_area"]:
-            continue
-
-        # Compute the bounding box for the contour
-        (x, y, w, h) = cv2.boundingRect(c)
-        
-        # Exclude the area of the timestamp from processing of detected motion.
-        # We don't want the updating of that to be detected as motion and keep
-        # the recording alive forever.
-        # NOTE:  These values
-        if not (x_min <= x <= x_max and y_min <= y <= y_max):
-            # Temporary info to help determine / tun the above values.
-            # May still need some teaking for the lower limit of x, for hour,
-            # day, year changes.  Probably not worth the effort though.
-            #print("x:", x, "y:", y, "w:", w, "h:", h)
-            new_state = State.ACTIVE    
+    # Start or stop recording as needed.
+    state = surveillance.update(boxes)
  
-            # Draw the bounding box on the frame, and update the text.
-            cv2.rectangle(frame, (x, y), (x + w, y + h), (0, 255, 0), 2)
-        
-            # Update the last_active_time to now (keep the recording going).
-            last_active_time = datetime.datetime.now()
+    if frame is None:
+        continue
  
-    if new_state == State.ACTIVE:
-        # Motion has been detected, so the scene is now ACTIVE.
-        if state == State.IDLE:
-            # Transitioning from IDLE to ACTIVE, so we need to start recording.
-            VideoRecorder.start()
-        state = State.ACTIVE
-        
-    elif new_state == State.RECORDING:
-        state = State.RECORDING
-    
-    elif new_state == State.IDLE:
-        if state != State.IDLE:
-            # Transitioning from RECORDING to IDLE.  Stop the recording.
-            state = State.IDLE
-            VideoRecorder.stop()
+    # Draw the bounding boxes of the areas of motion on the frame.  The detector
+    # has already dropped those that are too small (min_area) or are just the
+    # timestamp updating.
+    for (x, y, w, h) in boxes:
+        cv2.rectangle(frame, (x, y), (x + w, y + h), (0, 255, 0), 2)
  
     # draw the text on the frame
     if state == State.IDLE:
@@ -210,12 +176,7 @@ for f in camera.capture_continuous(rawCapture, format="bgr", use_video_port=True
         # If the `q` key is pressed, break from the loop.
         if key == ord("q"):
             print("q pressed, time to quit")
-            if state != State.IDLE:
-                VideoRecorder.stop()
-            VideoRecorder.quit()
+            shut_down()
             print("now exit")
             exit(0)
- 
-    # Clear the stream in preparation for the next frame.
-    rawCapture.truncate(0)
     